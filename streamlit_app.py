@@ -1,9 +1,23 @@
 import io
 import re
+import itertools
+import threading
+import warnings
 import requests
+import numpy as np
 import pandas as pd
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+try:
+    import python_calamine  # noqa: F401  (optional: faster Excel parsing, pandas >= 2.2)
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+
+_GSHEET_RE = re.compile(r"spreadsheets/d/(?P<id>[A-Za-z0-9_-]+)(?:/[^?#]*)?(?:[?#](?:[^#]*?[&#])?gid=(?P<gid>\d+))?")
 
 st.set_page_config(page_title="GL Reconciliation Checker", layout="wide")
 
@@ -57,121 +71,160 @@ with st.expander("Optional: Map your column names (if different from defaults)")
     }
     colmap = {k: st.text_input(k, v) for k, v in defaults.items()}
 STD_COLS = list(defaults.keys())
+DATE_COLS = ["period_end_date", "prepared_on", "approved_on"]
+_TRUTHY = frozenset({"y", "yes", "true", "1", "t"})
+NUMERIC_DEFAULTS = {"gl_ending_balance": 0.0, "subledger_ending_balance": 0.0, "items_over_aging_threshold": 0}
+CSV_CHUNK_BYTES = 50 * 1024 * 1024
+CSV_CHUNK_ROWS = 100_000
+EXCEL_MAX_ROWS = 1_048_575  # one sheet, less the header row
 
-def normalize(df, colmap):
-    df = df.copy()
-    for std, src in colmap.items():
-        if src in df.columns:
-            df.rename(columns={src: std}, inplace=True)
-        else:
-            df[std] = None
-    return df[STD_COLS].copy()
-
-def parse_date_safe(x):
-    if pd.isna(x) or x is None:
-        return None
-    try:
-        return pd.to_datetime(x).date()
-    except Exception:
-        return None
+def _to_naive_datetime(s):
+    # format="mixed" parses each value on its own instead of inferring one format
+    # from the first row; tz-aware values keep their local wall time, like .date() did.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        out = pd.to_datetime(s, errors="coerce", format="mixed")
+    if isinstance(out.dtype, pd.DatetimeTZDtype):
+        return out.dt.tz_localize(None)
+    if out.dtype == object:  # mixed UTC offsets
+        out = pd.to_datetime(out.map(lambda t: t.replace(tzinfo=None) if isinstance(t, datetime) else t), errors="coerce")
+    return out
 
-def to_bool(x):
-    if isinstance(x, str):
-        return x.strip().lower() in ["y","yes","true","1"]
-    if isinstance(x, (int, float)):
-        return bool(x)
-    return False
+def normalize(df, colmap):
+    rename_map = {src: std for std, src in colmap.items() if src in df.columns and src != std}
+    df = df.rename(columns=rename_map, copy=False).reindex(columns=STD_COLS, copy=False)
+    for c in DATE_COLS:
+        df[c] = _to_naive_datetime(df[c])
+    for c, default in NUMERIC_DEFAULTS.items():
+        df[c] = pd.to_numeric(df[c], errors="coerce").fillna(default).astype(type(default))
+    for c in ("entity", "account_id"):
+        df[c] = df[c].astype("category")
+    # preparer/approver are compared as text (101 == "101") and share one set of
+    # categories so the SoD check can compare codes
+    for c in ("preparer", "approver"):
+        df[c] = df[c].astype(str).where(df[c].notna())
+    people = pd.CategoricalDtype(pd.unique(pd.concat([df["preparer"], df["approver"]]).dropna()))
+    for c in ("preparer", "approver"):
+        df[c] = df[c].astype(people)
+    return df
 
 def evaluate(df, crit, checklist_version="v1"):
-    results = []
     run_id = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    for _, r in df.iterrows():
-        entity = r.get("entity")
-        account_id = r.get("account_id")
-        account_name = r.get("account_name")
-        period_end = parse_date_safe(r.get("period_end_date"))
-        gl_bal = float(r.get("gl_ending_balance") or 0.0)
-        sub_bal = float(r.get("subledger_ending_balance") or 0.0)
-        preparer = str(r.get("preparer") or "")
-        approver = str(r.get("approver") or "")
-        approved_on = parse_date_safe(r.get("approved_on"))
-        items_over = int(r.get("items_over_aging_threshold") or 0)
-        plan = to_bool(r.get("action_plan_present"))
-        evidence = r.get("documentation_links") or ""
-
-        variance = gl_bal - sub_bal
-        tol_abs = float(crit.get("tieout_tolerance_abs", 0.0))
-        tol_pct = float(crit.get("tieout_tolerance_pct", 0.0))
-        tol = max(tol_abs, abs(gl_bal) * tol_pct)
-        tieout_pass = abs(variance) <= tol
-
-        sod_required = bool(crit.get("require_sod", True))
-        sod_pass = (preparer != approver) if sod_required else True
-
-        sla_days = int(crit.get("timeliness_sla_days", 5))
-        sla_over = None
-        timely_pass = True
-        if approved_on and period_end:
-            delta_days = (approved_on - period_end).days
-            sla_over = max(0, delta_days - sla_days)
-            timely_pass = delta_days <= sla_days
-
-        allow_over_with_plan = bool(crit.get("allow_items_over_threshold_with_plan", True))
-        aging_pass = (items_over == 0) or (allow_over_with_plan and plan)
-
-        failures, severity = [], "low"
-        if not tieout_pass:
-            failures.append(f"Tie-out variance {variance:,.2f} exceeds tolerance {tol:,.2f}")
-            severity = "high"
-        if not sod_pass:
-            failures.append("Segregation of duties failed (preparer equals approver)")
-            severity = "high"
-        if not timely_pass:
-            failures.append(f"Approval exceeded SLA by {sla_over} day(s)")
-            severity = "medium" if severity != "high" else "high"
-        if not aging_pass:
-            failures.append("Aged items without action plan")
-            severity = "medium" if severity == "low" else severity
-
-        status = "pass" if not failures else ("fail" if severity == "high" else "warn")
-        rationale = " | ".join(failures) if failures else "All checks passed within thresholds."
-
-        results.append({
-            "entity": entity,
-            "account_id": account_id,
-            "account_name": account_name,
-            "period_end_date": period_end,
-            "status": status,
-            "severity": severity,
-            "rationale": rationale,
-            "variance_amount": variance,
-            "sla_days_over": sla_over if sla_over is not None else 0,
-            "sod_violation": (not sod_pass),
-            "aged_items_flag": (not aging_pass),
-            "evidence_link": evidence
-        })
-    return pd.DataFrame(results)
+    tol_abs = float(crit.get("tieout_tolerance_abs", 0.0))
+    tol_pct = float(crit.get("tieout_tolerance_pct", 0.0))
+    sod_required = bool(crit.get("require_sod", True))
+    sla_days = int(crit.get("timeliness_sla_days", 5))
+    allow_over_with_plan = bool(crit.get("allow_items_over_threshold_with_plan", True))
+
+    gl_bal = df["gl_ending_balance"].to_numpy()
+    sub_bal = df["subledger_ending_balance"].to_numpy()
+    items_over = df["items_over_aging_threshold"].to_numpy()
+    plan = df["action_plan_present"]
+    if pd.api.types.is_numeric_dtype(plan):
+        plan = plan.fillna(0).astype(bool).to_numpy()
+    else:
+        plan = plan.astype(str).str.strip().str.lower().isin(_TRUTHY).to_numpy()
+
+    variance = gl_bal - sub_bal
+    tol = np.maximum(tol_abs, np.abs(gl_bal) * tol_pct)
+    fail_tieout = ~(np.abs(variance) <= tol)
+
+    if sod_required:
+        fail_sod = df["preparer"].cat.codes.to_numpy() == df["approver"].cat.codes.to_numpy()
+    else:
+        fail_sod = np.zeros(len(df), dtype=bool)
+
+    # Rows missing either date are treated as timely, with no SLA overrun.
+    period_end = df["period_end_date"].dt.normalize()
+    delta_days = (df["approved_on"].dt.normalize() - period_end).dt.days
+    has_dates = delta_days.notna().to_numpy()
+    delta_days = delta_days.fillna(0).to_numpy(dtype="int64")
+    sla_over = np.where(has_dates, np.maximum(0, delta_days - sla_days), 0)
+    fail_timely = has_dates & (delta_days > sla_days)
+
+    fail_aging = ~((items_over == 0) | (allow_over_with_plan & plan))
+
+    sev_high = fail_tieout | fail_sod
+    sev_med = ~sev_high & (fail_timely | fail_aging)
+    any_fail = sev_high | fail_timely | fail_aging
+    severity = np.select([sev_high, sev_med], ["high", "medium"], default="low")
+    status = np.select([~any_fail, sev_high], ["pass", "fail"], default="warn")
+
+    # Messages are only formatted for the rows that fail each check.
+    tieout_msg = np.full(len(df), "", dtype=object)
+    tieout_msg[fail_tieout] = (
+        "Tie-out variance " + pd.Series(variance[fail_tieout]).map("{:,.2f}".format).astype(str)
+        + " exceeds tolerance " + pd.Series(tol[fail_tieout]).map("{:,.2f}".format).astype(str)
+    ).to_numpy()
+    timely_msg = np.full(len(df), "", dtype=object)
+    timely_msg[fail_timely] = "Approval exceeded SLA by " + sla_over[fail_timely].astype(str).astype(object) + " day(s)"
+    checks = [
+        (fail_tieout, tieout_msg),
+        (fail_sod, "Segregation of duties failed (preparer equals approver)"),
+        (fail_timely, timely_msg),
+        (fail_aging, "Aged items without action plan"),
+    ]
+    rationale = np.full(len(df), "", dtype=object)
+    for fail, msg in checks:
+        msg = msg[fail] if isinstance(msg, np.ndarray) else msg
+        rationale[fail] = rationale[fail] + np.where(rationale[fail] == "", "", " | ").astype(object) + msg
+    rationale[~any_fail] = "All checks passed within thresholds."
+
+    return pd.DataFrame({
+        "entity": df["entity"].array,
+        "account_id": df["account_id"].array,
+        "account_name": df["account_name"].to_numpy(),
+        "period_end_date": period_end.to_numpy(),
+        "status": status,
+        "severity": severity,
+        "rationale": rationale,
+        "variance_amount": variance,
+        "sla_days_over": sla_over,
+        "sod_violation": fail_sod,
+        "aged_items_flag": fail_aging,
+        "evidence_link": df["documentation_links"].fillna("").to_numpy(),
+    }, copy=False)
+
+@st.cache_data(show_spinner=False, max_entries=16, ttl=3600)
+def _parse_bytes(name, data):
+    if name.endswith(".csv"):
+        # C engine: unlike engine="pyarrow" it rejects non-UTF-8 input and leaves
+        # UTC offsets in timestamps for normalize() to strip.
+        return pd.read_csv(io.BytesIO(data), encoding="utf-8", engine="c", on_bad_lines="skip")
+    return pd.read_excel(io.BytesIO(data), engine=EXCEL_ENGINE)
+
+def _is_large_csv(f):
+    return f.name.lower().endswith(".csv") and getattr(f, "size", 0) > CSV_CHUNK_BYTES
 
 def read_uploaded(files):
-    frames = []
-    for f in files:
-        name = f.name.lower()
-        try:
-            if name.endswith(".csv"):
-                df = pd.read_csv(f, encoding="utf-8", engine="python", on_bad_lines="skip")
-            else:
-                df = pd.read_excel(f)
-            frames.append(df)
-        except Exception as e:
-            st.warning(f"Skipping {f.name}: {e}")
-    return frames
+    # Smaller files are parsed concurrently (and cached); large CSVs are streamed
+    # in chunks on this thread and deliberately bypass the cache.
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=min(8, len(files)),
+                            initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as ex:
+        pending = [None if _is_large_csv(f) else ex.submit(_parse_bytes, f.name.lower(), f.getvalue()) for f in files]
+        for f, fut in zip(files, pending):
+            rows = 0
+            try:
+                if fut is None:
+                    for chunk in pd.read_csv(f, encoding="utf-8", engine="c", on_bad_lines="skip", chunksize=CSV_CHUNK_ROWS):
+                        rows += len(chunk)
+                        yield chunk
+                else:
+                    yield fut.result()
+            except Exception as e:
+                if rows:
+                    st.warning(f"{f.name} was only partially loaded: reading stopped after {rows:,} rows ({e}). "
+                               "The rows read before the error are included in the results.")
+                else:
+                    st.warning(f"Skipping {f.name}: {e}")
 
 def gsheet_to_csv_export(url: str):
-    m = re.match(r".*spreadsheets/d/([a-zA-Z0-9-_]+).*?(?:gid=([0-9]+))?.*", url)
+    m = _GSHEET_RE.search(url)
     if not m:
         return None
-    sheet_id = m.group(1)
-    gid = m.group(2) or "0"
+    sheet_id = m.group("id")
+    gid = m.group("gid") or "0"
     return f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid={gid}"
 
 def read_gsheet(url):
@@ -180,10 +233,10 @@ def read_gsheet(url):
         st.error("Could not parse Google Sheets URL. Please ensure it’s a standard Sheets link or upload as Excel/CSV.")
         return None
     try:
-        resp = requests.get(export, timeout=15)
-        resp.raise_for_status()
-        df = pd.read_csv(io.BytesIO(resp.content))
-        return df
+        with requests.get(export, stream=True, timeout=15) as resp:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            return pd.read_csv(resp.raw)
     except Exception as e:
         st.error(f"Failed to fetch Google Sheet: {e}")
         return None
@@ -191,34 +244,70 @@ def read_gsheet(url):
 run = st.button("2) Run checks")
 
 if run:
-    frames = []
+    sources = []
     if uploaded_files:
-        frames.extend(read_uploaded(uploaded_files))
+        sources.append(read_uploaded(uploaded_files))
     if gsheet_url.strip():
         df_gs = read_gsheet(gsheet_url.strip())
         if df_gs is not None:
-            frames.append(df_gs)
+            sources.append([df_gs])
 
-    if not frames:
+    # Evaluate chunk by chunk so only the compact results are held for every row;
+    # normalized input is kept for the workbook only while it fits on one sheet.
+    input_chunks, result_chunks, input_rows = [], [], 0
+    for chunk in itertools.chain.from_iterable(sources):
+        df_norm = normalize(chunk, colmap)
+        result_chunks.append(evaluate(df_norm, crit))
+        input_rows += len(df_norm)
+        if input_rows <= EXCEL_MAX_ROWS:
+            input_chunks.append(df_norm)
+        else:
+            input_chunks.clear()
+
+    if not result_chunks:
         st.warning("No data found. Upload a file or provide a valid Google Sheets URL.")
     else:
-        dfs_norm = [normalize(df, colmap) for df in frames]
-        df_all = pd.concat(dfs_norm, ignore_index=True)
-        df_results = evaluate(df_all, crit)
+        df_all = pd.concat(input_chunks, ignore_index=True, copy=False) if input_rows <= EXCEL_MAX_ROWS else None
+        df_results = pd.concat(result_chunks, ignore_index=True, copy=False)
 
         st.success("Checks complete.")
+        if df_all is None:
+            st.info(f"Input has {input_rows:,} rows, more than fit on one Excel sheet; the GL_Recon_Input and Results "
+                    "sheets are left out of the workbook, which holds only the criteria. Download the full results as CSV below.")
         st.subheader("Results preview")
         st.dataframe(df_results.head(100))
 
         ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
         excel_name = f"gl_recon_results_{ts}.xlsx"
         out = io.BytesIO()
-        with pd.ExcelWriter(out, engine="xlsxwriter", datetime_format="yyyy-mm-dd") as writer:
-            df_all.to_excel(writer, sheet_name="GL_Recon_Input", index=False)
+        # Not constant_memory: pandas writes cells column by column, which that mode would drop.
+        with pd.ExcelWriter(out, engine="xlsxwriter", datetime_format="yyyy-mm-dd",
+                            engine_kwargs={"options": {"in_memory": True}}) as writer:
+            if df_all is not None:
+                df_all.to_excel(writer, sheet_name="GL_Recon_Input", index=False)
             pd.DataFrame([crit]).to_excel(writer, sheet_name="Criteria", index=False)
-            df_results.to_excel(writer, sheet_name="Results", index=False)
+            if len(df_results) <= EXCEL_MAX_ROWS:
+                df_results.to_excel(writer, sheet_name="Results", index=False)
         out.seek(0)
-        st.download_button("Download Results Excel", data=out, file_name=excel_name)
+        if len(df_results) <= EXCEL_MAX_ROWS:
+            st.download_button("Download Results Excel", data=out, file_name=excel_name)
+        else:
+            st.download_button("Download Criteria Excel", data=out, file_name=f"gl_recon_criteria_{ts}.xlsx")
+            st.download_button("Download Results CSV", data=df_results.to_csv(index=False),
+                               file_name=f"gl_recon_results_{ts}.csv")
+
+        # Identifier columns can mix numbers and text (e.g. 1001 and "1001-A"), which
+        # Arrow cannot store in one typed column, so write them as strings.
+        df_parquet = df_results.copy(deep=False)
+        for c in ("entity", "account_id", "account_name", "evidence_link"):
+            if df_parquet[c].dtype == object or isinstance(df_parquet[c].dtype, pd.CategoricalDtype):
+                df_parquet[c] = df_parquet[c].astype("string")
+        try:
+            parquet = df_parquet.to_parquet(compression="zstd", index=False)
+        except Exception as e:
+            st.warning(f"Parquet export unavailable: {e}")
+        else:
+            st.download_button("Download Results Parquet", data=parquet, file_name=f"gl_recon_results_{ts}.parquet")
 
 st.markdown("---")
 st.caption("Expected columns (or map yours): entity, account_id, account_name, period_start_date, period_end_date, gl_ending_balance, subledger_ending_balance, preparer, prepared_on, approver, approved_on, reconciling_items_count, items_over_aging_threshold, action_plan_present, documentation_links.")